@@ -1,30 +1,48 @@
+import collections
 import logging
-from typing import Dict, Type, Tuple, Optional
+from typing import Dict, Type, Tuple, Optional, List
 
 import numpy as np
 import torch as th
 import torch.nn.functional as F
+import dataclasses
 from dataclasses import dataclass
 from torch import nn
 
 from layers import CrossProduct, Sum
 
 from rat_spn import RatSpn, RatSpnConfig
-import matplotlib.pyplot as plt
 
 logger = logging.getLogger(__name__)
 
 
 def print_cspn_params(cspn):
-    def count_params(model):
-        return sum(p.numel() for p in model.parameters() if p.requires_grad)
-    print(f"Total params in CSPN: {count_params(cspn)}")
-    print(f"Params to extract features from the conditional: {count_params(cspn.feat_layers)}")
-    print(f"Params in MLP for the sum params, excluding the heads: {count_params(cspn.sum_layers)}")
-    print(f"Params in the heads of the sum param MLPs: {sum([count_params(head) for head in cspn.sum_param_heads])}")
-    print(f"Params in MLP for the dist params, excluding the heads: {count_params(cspn.dist_layers)}")
-    print(f"Params in the heads of the dist param MLPs: "
-          f"{count_params(cspn.dist_mean_head) + count_params(cspn.dist_std_head)}")
+    # Count the params of all submodules in a single pass over the params of the CSPN
+    counts = collections.Counter()
+    for name, p in cspn.named_parameters():
+        if p.requires_grad:
+            counts[name.split('.', 1)[0]] += p.numel()
+    print(f"Total params in CSPN: {sum(counts.values())}")
+    print(f"Params to extract features from the conditional: {counts['feat_layers']}")
+    print(f"Params in MLP for the sum params, excluding the heads: {counts['sum_layers']}")
+    print(f"Params in the heads of the sum param MLPs: {counts['sum_param_head']}")
+    print(f"Params in MLP for the dist params, excluding the heads: {counts['dist_layers']}")
+    print(f"Params in the heads of the dist param MLPs: {counts['dist_param_head']}")
+
+
+def fuse_linear_heads(heads: List[nn.Linear]) -> nn.Linear:
+    """
+    Stack the weights and biases of Linear layers with the same input size into a single Linear layer.
+    The output of the fused layer is the concatenation of the outputs of the given layers, in the given order.
+    """
+    in_features = heads[0].in_features
+    assert all(head.in_features == in_features for head in heads), "All heads must have the same input size!"
+    fused = nn.Linear(in_features, sum(head.out_features for head in heads),
+                      device=heads[0].weight.device, dtype=heads[0].weight.dtype)
+    with th.no_grad():
+        fused.weight.copy_(th.cat([head.weight for head in heads], dim=0))
+        fused.bias.copy_(th.cat([head.bias for head in heads], dim=0))
+    return fused
 
 
 @dataclass
@@ -38,12 +56,11 @@ class CspnConfig(RatSpnConfig):
     sum_param_layers: list = None
     dist_param_layers: list = None
     cond_layers_inner_act: Type[nn.Module] = nn.LeakyReLU
-
-    def __setattr__(self, key, value):
-        if hasattr(self, key):
-            super().__setattr__(key, value)
-        else:
-            raise AttributeError(f"CspnConfig object has no attribute {key}")
+    use_compile: bool = False  # Compile the computations of CSPN.set_params with torch.compile
+    use_jit: bool = False  # Script the feature extraction layers and the MLPs for the sum and dist params
+    use_amp: bool = False  # On CUDA, compute the params in set_params under bfloat16 autocast
+    # On CUDA and with gradients disabled, replay CUDA graphs of CSPN.set_params. Ignored if use_compile is set.
+    use_cuda_graphs: bool = False
 
 
 class CSPN(RatSpn):
@@ -54,21 +71,105 @@ class CSPN(RatSpn):
         Args:
             config (CspnConfig): Cspn configuration object.
         """
+        assert not config.use_compile or hasattr(th, 'compile'), \
+            f"use_compile needs torch.compile, which was added in torch 2.0, but torch is {th.__version__}!"
         super().__init__(config=config)
         self.config: CspnConfig = config
-        self.dist_std_head = None
-        self.dist_mean_head = None
+        self.dist_param_head = None
         self.dist_layers = None
-        self.sum_param_heads = None
+        self.sum_param_head = None
+        self._sum_split_sizes = None
+        self._sum_layer_meta = None
+        self._cross_product_layers = None
         self.sum_layers = None
+        # Created on the first call of set_params if config.use_compile is set.
+        self._compiled_compute_params = None
+        # Output buffers of the param heads, reused by set_params when gradients are disabled. See apply_param_head.
+        self._param_head_bufs: Dict[str, th.Tensor] = {}
+        # The conditional of the last set_params call without gradients and the versions it was computed with,
+        # and the params whose versions are checked. See set_params.
+        self._last_condition: Optional[th.Tensor] = None
+        self._last_condition_versions: Optional[tuple] = None
+        self._versioned_params: Optional[Tuple[th.Tensor, ...]] = None
+        # CUDA graphs of compute_params with their static input and outputs, one per conditional shape,
+        # and the memory pool that all of them share.
+        self._cuda_graphs: Dict[tuple, Tuple[th.cuda.CUDAGraph, th.Tensor, tuple]] = {}
+        self._cuda_graph_pool = None
         self.feat_layers = None
+        if config.C == 1:
+            # A sum over a single channel with weight log(1) = 0 doesn't change its input, so the CSPN has no
+            # sampling root and set_params doesn't need to set its weights.
+            self._sampling_root = None
         self.replace_layer_params()
         self.create_feat_layers(config.F_cond)
+        if self._sampling_root is not None:
+            # The weights of the sampling root are always log(1/C). set_params only broadcasts this cached value.
+            self.register_buffer('_log_inv_C', th.tensor(-np.log(config.C), dtype=th.float), persistent=False)
 
     @property
     def device(self):
         """Small hack to obtain the current device."""
-        return self.dist_mean_head.bias.device
+        return self.dist_param_head.bias.device
+
+    def autocast(self):
+        """
+            Autocast context for the computation of the params in set_params. Only enabled if config.use_amp is set
+            and on CUDA. The SPN itself is never autocast, as its log-likelihoods would lose too much precision
+            in bfloat16.
+        """
+        # Cached weight casts must not be used in CUDA graphs, as they are freed when the autocast context is left.
+        return th.autocast('cuda', dtype=th.bfloat16, enabled=self.config.use_amp and self.device.type == 'cuda',
+                           cache_enabled=not self.config.use_cuda_graphs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # State dicts from before the param heads were fused have one head per Sum layer and one for each leaf param.
+        # Their weights and biases are stacked in the same order as in fuse_linear_heads.
+        unfused_heads = {
+            'sum_param_head': [f"sum_param_heads.{i}" for i in range(len(self._sum_layer_meta))],
+            'dist_param_head': ['dist_mean_head', 'dist_std_head'],
+        }
+        for head, unfused in unfused_heads.items():
+            if f"{prefix}{unfused[0]}.weight" in state_dict:
+                for param in ['weight', 'bias']:
+                    state_dict[f"{prefix}{head}.{param}"] = th.cat(
+                        [state_dict.pop(f"{prefix}{name}.{param}") for name in unfused], dim=0
+                    )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # CSPNs that were pickled before the param heads were fused have one head per Sum layer and two dist heads.
+        if 'sum_param_heads' in self._modules:
+            sum_param_heads = list(self._modules.pop('sum_param_heads'))
+            self.sum_param_head = fuse_linear_heads(sum_param_heads)
+            self._sum_split_sizes = [head.out_features for head in sum_param_heads]
+            self.dist_param_head = fuse_linear_heads(
+                [self._modules.pop('dist_mean_head'), self._modules.pop('dist_std_head')]
+            )
+            self._find_param_layers()
+            self._compiled_compute_params = None
+            self._param_head_bufs = {}
+            self._last_condition = None
+            self._last_condition_versions = None
+            self._versioned_params = None
+            self._cuda_graphs = {}
+            self._cuda_graph_pool = None
+            if self.config.C == 1:
+                self._sampling_root = None
+            else:
+                self.register_buffer('_log_inv_C', th.tensor(-np.log(self.config.C), dtype=th.float,
+                                                             device=self.sum_param_head.weight.device),
+                                     persistent=False)
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting the params invalidates the buffers and the CUDA graphs, which point to the old memory,
+        # and the params set for the last conditional, which were computed with the old params.
+        self._param_head_bufs = {}
+        self._cuda_graphs = {}
+        self._cuda_graph_pool = None
+        self._last_condition = None
+        self._versioned_params = None
+        return super()._apply(fn, *args, **kwargs)
 
     def forward(self, x: th.Tensor, condition: th.Tensor = None, **kwargs) -> th.Tensor:
         """
@@ -96,7 +197,7 @@ class CSPN(RatSpn):
                 f"Dim of input is 2. This means that each input sample belongs to one conditional. " \
                 f"But the number of samples ({x.shape[0]}) doesn't match the number of conditionals ({weight_sets})!" \
                 f"Did you forget to set the weights of the CSPN?"
-            x = x.unsqueeze(0)
+            x = x[None]
 
         return super().forward(x, **kwargs)
 
@@ -152,63 +253,42 @@ class CSPN(RatSpn):
         return self.sample(mode='onehot', **kwargs)
 
     def replace_layer_params(self):
+        """
+            Replaces the nn.Parameters of the sum and dist layers with placeholder tensors, as these
+            params are set by set_params. The parameters are removed from the _parameters dict of the layers directly,
+            which saves nn.Module.__delattr__ and nn.Module.__setattr__ from walking through the dicts of the module.
+        """
+        def replace(module: nn.Module, name: str, placeholder: th.Tensor):
+            module._parameters.pop(name)
+            object.__setattr__(module, name, placeholder)
+
         for layer in self._inner_layers:
             if isinstance(layer, Sum):
-                placeholder = th.zeros_like(layer.weight_param)
-                del layer.weight_param
-                layer.weight_param = placeholder
-        placeholder = th.zeros_like(self.root.weight_param)
-        del self.root.weight_param
-        self.root.weight_param = placeholder
-
-        placeholder = th.zeros_like(self._sampling_root.weight_param)
-        del self._sampling_root.weight_param
-        self._sampling_root.weight_param = placeholder
+                replace(layer, 'weight_param', th.zeros_like(layer.weight_param))
+        replace(self.root, 'weight_param', th.zeros_like(self.root.weight_param))
+        if self._sampling_root is not None:
+            replace(self._sampling_root, 'weight_param', th.zeros_like(self._sampling_root.weight_param))
 
         placeholder = th.zeros_like(self._leaf.base_leaf.mean_param)
-        del self._leaf.base_leaf.mean_param
-        del self._leaf.base_leaf.std_param
-        self._leaf.base_leaf.mean_param = placeholder
-        self._leaf.base_leaf.std_param = placeholder
+        replace(self._leaf.base_leaf, 'mean_param', placeholder)
+        replace(self._leaf.base_leaf, 'std_param', placeholder)
 
     def create_feat_layers(self, feature_dim: tuple):
-        assert len(feature_dim) == 3 or len(feature_dim) == 1, \
-            f"Don't know how to construct feature extraction layers for features of dim {len(feature_dim)}."
-        if len(feature_dim) == 3:
-            # feature_dim = (channels, rows, columns)
-            assert False, "Adapt conv layer feat extraction to config.feat_layer_sizes"
-            conv_kernel = self.config.conv_kernel_size
-            pool_kernel = self.config.conv_pooling_kernel_size
-            pool_stride = self.config.conv_pooling_stride
-            nr_feat_layers = 0
-            conv_layers = [] if nr_feat_layers > 0 else [nn.Identity()]
-            for j in range(nr_feat_layers):
-                # feature_dim = [int(np.floor((n - (pool_kernel-1) - 1)/pool_stride + 1)) for n in feature_dim]
-                in_channels = feature_dim[0]
-                if j == nr_feat_layers-1:
-                    out_channels = 1
-                else:
-                    out_channels = feature_dim[0]
-                conv_layers += [nn.Conv2d(in_channels, out_channels,
-                                          kernel_size=(conv_kernel, conv_kernel), padding='same'),
-                                nn.ReLU(),
-                                nn.MaxPool2d(kernel_size=pool_kernel, stride=pool_stride),
-                                nn.Dropout()]
-            self.feat_layers = nn.Sequential(*conv_layers)
-        elif len(feature_dim) == 1:
-            if self.config.feat_layers:
-                feat_layers = []
-                layer_sizes = [feature_dim[0]] + self.config.feat_layers
-                for j in range(len(layer_sizes) - 1):
-                    feat_layers += [nn.Linear(layer_sizes[j], layer_sizes[j+1]),
-                                    self.config.cond_layers_inner_act()]
-            else:
-                feat_layers = [nn.Identity()]
-            self.feat_layers = nn.Sequential(*feat_layers)
+        assert len(feature_dim) == 1, \
+            f"Only conditionals of dim 1 are supported, but the conditional has dim {len(feature_dim)}."
+        if self.config.feat_layers:
+            feat_layers = []
+            layer_sizes = [feature_dim[0]] + self.config.feat_layers
+            for j in range(len(layer_sizes) - 1):
+                feat_layers += [nn.Linear(layer_sizes[j], layer_sizes[j+1]),
+                                self.config.cond_layers_inner_act()]
+        else:
+            feat_layers = [nn.Identity()]
+        self.feat_layers = nn.Sequential(*feat_layers)
+        feature_dim = self.config.feat_layers[-1] if self.config.feat_layers else feature_dim[0]
 
         output_activation = nn.Identity
 
-        feature_dim = int(np.prod(self.feat_layers(th.ones((1, *feature_dim))).shape))
         # print(f"The feature extraction layer for the CSPN conditional reduce the {int(np.prod(feature_dim))} "
               # f"inputs (e.g. pixels in an image) down to {feature_dim} features. These are the inputs of the "
               # f"MLPs which set the sum and dist params.")
@@ -224,13 +304,12 @@ class CSPN(RatSpn):
             sum_layers = [nn.Identity()]
         self.sum_layers = nn.Sequential(*sum_layers)
 
-        self.sum_param_heads = nn.ModuleList()
-        for layer in self._inner_layers:
-            if isinstance(layer, Sum):
-                self.sum_param_heads.append(nn.Linear(sum_layer_sizes[-1], layer.weight_param.numel()))
-                # print(f"Sum layer has {layer.weight_param.numel()} weights.")
-        self.sum_param_heads.append(nn.Linear(sum_layer_sizes[-1], self.root.weight_param.numel()))
-        # print(f"Root sum layer has {self.root.weight_param.numel()} weights.")
+        self._find_param_layers()
+
+        sum_param_heads = []
+        for layer, _ in self._sum_layer_meta:
+            sum_param_heads.append(nn.Linear(sum_layer_sizes[-1], layer.weight_param.numel()))
+            # print(f"Sum layer has {layer.weight_param.numel()} weights.")
 
         # dist_layer_sizes = [int(feature_dim * 10 ** (-i)) for i in range(1 + self.config.fc_dist_param_layers)]
         dist_layer_sizes = [feature_dim]
@@ -244,8 +323,31 @@ class CSPN(RatSpn):
             dist_layers = [nn.Identity()]
         self.dist_layers = nn.Sequential(*dist_layers)
 
-        self.dist_mean_head = nn.Linear(dist_layer_sizes[-1], self._leaf.base_leaf.mean_param.numel())
-        self.dist_std_head = nn.Linear(dist_layer_sizes[-1], self._leaf.base_leaf.std_param.numel())
+        dist_mean_head = nn.Linear(dist_layer_sizes[-1], self._leaf.base_leaf.mean_param.numel())
+        dist_std_head = nn.Linear(dist_layer_sizes[-1], self._leaf.base_leaf.std_param.numel())
+
+        # The heads are fused only after all of them were created, so their initialization is the same as if they
+        # were separate layers. In set_params, all sum weights and all dist params are then computed in one GEMM each.
+        self.sum_param_head = fuse_linear_heads(sum_param_heads)
+        self._sum_split_sizes = [head.out_features for head in sum_param_heads]
+        self.dist_param_head = fuse_linear_heads([dist_mean_head, dist_std_head])
+
+        if self.config.use_jit:
+            assert not self.config.use_compile, "torch.compile can't trace through scripted modules, " \
+                                                "so use_jit and use_compile can't be set together!"
+            # The JIT fuses the bias-add of the Linear layers with the activation that follows.
+            self.feat_layers = th.jit.script(self.feat_layers)
+            self.sum_layers = th.jit.script(self.sum_layers)
+            self.dist_layers = th.jit.script(self.dist_layers)
+
+    def _find_param_layers(self):
+        # The Sum layers whose weights are set by set_params, root layer last, each with the shape of its weights
+        # without the conditionals dimension. The remaining inner layers only need to know the number of conditionals.
+        self._sum_layer_meta: List[Tuple[Sum, Tuple[int, ...]]] = [
+            (layer, (layer.in_features, layer.in_channels, layer.out_channels, layer.num_repetitions))
+            for layer in [*self._inner_layers, self.root] if isinstance(layer, Sum)
+        ]
+        self._cross_product_layers = [layer for layer in self._inner_layers if not isinstance(layer, Sum)]
 
     def create_one_hot_in_channel_mapping(self):
         for lay in self._inner_layers:
@@ -259,66 +361,174 @@ class CSPN(RatSpn):
         """
             Sets the weights of the sum and dist nodes, using the input from the conditional passed through the
             feature extraction layers.
-            The weights of the sum nodes are normalized in log space (log-softmaxed) over the input channel dimension.
+            The weights of the sum nodes are normalized in log space (log-softmaxed) over the input channel dimension
+            by the Sum layers themselves, when they are first accessed.
             The distribution parameters are bounded as well via the bounding function of the leaf layer.
             So in the RatSpn class, any normalizing and bounding must only be done if the weights are of dimension 4,
             meaning that it is not a Cspn.
+            If gradients are disabled and this is called with the same conditional tensor as the previous call,
+            and neither the conditional nor the parameters of the CSPN were modified in-place since then
+            (e.g. by an optimizer step), the params that are already set are kept and nothing is computed.
+            With gradients, the params are always computed again, so that each call has its own autograd graph.
         """
-        num_conditionals = feat_inp.shape[0]
-        features = self.feat_layers(feat_inp)
-        features = features.flatten(start_dim=1)
-        sum_weights_pre_output = self.sum_layers(features)
+        # Inference tensors have no version counter, so their modifications can't be detected.
+        if not th.is_grad_enabled() and not feat_inp.is_inference():
+            if self._versioned_params is None:
+                self._versioned_params = tuple(self.parameters())
+            versions = (feat_inp._version, *[p._version for p in self._versioned_params])
+            if feat_inp is self._last_condition and versions == self._last_condition_versions:
+                return
+            # Keeping a reference to the conditional means that no other tensor can take its id() in the meantime.
+            self._last_condition = feat_inp
+            self._last_condition_versions = versions
+        else:
+            self._last_condition = None
 
-        # Set normalized sum node weights of the inner RatSpn layers
-        i = 0
-        for layer in self._inner_layers:
-            if isinstance(layer, Sum):
-                weight_shape = (num_conditionals, layer.in_features, layer.in_channels, layer.out_channels, layer.num_repetitions)
-                weights = self.sum_param_heads[i](sum_weights_pre_output).view(weight_shape)
-                layer.weight_param = F.log_softmax(weights, dim=2)
-                i += 1
+        num_conditionals = feat_inp.shape[0]
+        with self.autocast():
+            if self.config.use_compile:
+                if self._compiled_compute_params is None:
+                    self._compiled_compute_params = th.compile(self.compute_params, dynamic=False, fullgraph=True)
+                sum_weights, dist_means, dist_stds = self._compiled_compute_params(feat_inp)
+            elif self.config.use_cuda_graphs and feat_inp.is_cuda and not th.is_grad_enabled():
+                sum_weights, dist_means, dist_stds = self.compute_params_cuda_graph(feat_inp)
             else:
-                layer.num_conditionals = num_conditionals
+                sum_weights, dist_means, dist_stds = self.compute_params(feat_inp)
 
-        # Set normalized weights of the root sum layer
-        weight_shape = (num_conditionals, self.root.in_features, self.root.in_channels, self.root.out_channels, self.root.num_repetitions)
-        weights = self.sum_param_heads[i](sum_weights_pre_output).view(weight_shape)
-        self.root.weight_param = F.log_softmax(weights, dim=2)
+        # Set sum node weights of the inner RatSpn layers and the root sum layer.
+        # They are normalized by the layers when they are first used.
+        for (layer, _), weights in zip(self._sum_layer_meta, sum_weights):
+            layer.set_unnormalized_weights(weights)
+        for layer in self._cross_product_layers:
+            layer.num_conditionals = num_conditionals
 
-        # Sampling root weights need to have 5 dims as well
-        weight_shape = (num_conditionals, 1, 1, 1, 1)
-        self._sampling_root.weight_param = th.ones(weight_shape, device=self.device).mul_(1/self.config.C).log_()
+        if self._sampling_root is not None:
+            # Sampling root weights need to have 5 dims as well. This is a broadcast view, not a new tensor.
+            self._sampling_root.weight_param = self._log_inv_C.expand(num_conditionals, 1, 1, 1, 1)
 
         # Set bounded weights of the Gaussian distributions in the leaves
+        self._leaf.base_leaf.mean_param = dist_means
+        # depending on self._leaf.base_leaf_stds_are_in_lin_space, the stds are in log space or in linear space
+        self._leaf.base_leaf.std_param = dist_stds
+
+    def compute_params(self, feat_inp: th.Tensor) -> Tuple[List[th.Tensor], th.Tensor, th.Tensor]:
+        """
+            Computes the parameters that set_params assigns to the layers, without assigning them.
+            This function only consists of tensor operations, which is why it can be compiled with torch.compile.
+
+        Returns:
+            Tuple of
+                the unnormalized weights of all Sum layers in the order of the layers, root layer last,
+                the bounded means and the bounded stds of the leaf distributions.
+        """
+        num_conditionals = feat_inp.shape[0]
+        features = self.feat_layers(feat_inp)
+        features = features.flatten(start_dim=1)
+        sum_weights_pre_output = self.sum_layers(features)
+        # The weights of all sum layers come out of the fused head, in the order of the layers, root layer last.
+        # Under autocast, the heads output bfloat16. The sum weights and dist params are kept in full precision,
+        # as the log-likelihoods of the SPN are sums over many of them.
+        sum_weights = self.apply_param_head('sum', sum_weights_pre_output).float()
+        # Without grads, the trunk output can be freed before the dist trunk allocates its own
+        del sum_weights_pre_output
+        sum_weights = sum_weights.split(self._sum_split_sizes, dim=1)
+        sum_weights = [
+            weights.view(num_conditionals, *weight_shape)
+            for weights, (_, weight_shape) in zip(sum_weights, self._sum_layer_meta)
+        ]
+
         dist_param_shape = (num_conditionals, self._leaf.base_leaf.in_features, self.config.I, self.config.R)
         dist_weights_pre_output = self.dist_layers(features)
-        dist_means = self.dist_mean_head(dist_weights_pre_output).view(dist_param_shape)
-        dist_stds = self.dist_std_head(dist_weights_pre_output).view(dist_param_shape)
-        dist_means = self._leaf.base_leaf.bounded_means(dist_means)
-        dist_stds = self._leaf.base_leaf.bounded_stds(dist_stds)
+        dist_means, dist_stds = self.apply_param_head('dist', dist_weights_pre_output).float().chunk(2, dim=1)
+        dist_means = dist_means.view(dist_param_shape)
+        dist_stds = dist_stds.view(dist_param_shape)
+        if self._use_param_head_bufs():
+            # The dist params are bounded in place in the head output buffer, which has no autograd history
+            dist_means = self._leaf.base_leaf.bounded_means_(dist_means)
+            dist_stds = self._leaf.base_leaf.bounded_stds_(dist_stds)
+        else:
+            dist_means = self._leaf.base_leaf.bounded_means(dist_means)
+            dist_stds = self._leaf.base_leaf.bounded_stds(dist_stds)
         # if (dist_stds <= 0.0).any() or dist_stds.isnan().any():
             # print(1)
         # if (dist_stds ** 2 <= 0.0).any():
             # print(2)
-        self._leaf.base_leaf.mean_param = dist_means
-        # depending on self._leaf.base_leaf_stds_are_in_lin_space, the stds are in log space or in linear space
-        self._leaf.base_leaf.std_param = dist_stds
+        return sum_weights, dist_means, dist_stds
+
+    def compute_params_cuda_graph(self, feat_inp: th.Tensor) -> Tuple[List[th.Tensor], th.Tensor, th.Tensor]:
+        """
+            Replays compute_params from a CUDA graph. A graph is captured on the first call with a new shape of the
+            conditional, so with fixed batch sizes, all kernels of compute_params are launched at once.
+            Only valid if gradients are disabled.
+            The returned params are the static outputs of the graph. All graphs share one memory pool, so the params
+            are overwritten by the next replay of any of the graphs.
+        """
+        # A static input captured under inference_mode is an inference tensor, which can't be copied into outside of it
+        key = (feat_inp.shape, feat_inp.dtype, feat_inp.device, th.is_inference_mode_enabled())
+        if key not in self._cuda_graphs:
+            static_inp = feat_inp.clone()
+            # Warm up on a side stream before capturing, as recommended by the PyTorch docs
+            stream = th.cuda.Stream()
+            stream.wait_stream(th.cuda.current_stream())
+            with th.cuda.stream(stream):
+                self.compute_params(static_inp)
+            th.cuda.current_stream().wait_stream(stream)
+            graph = th.cuda.CUDAGraph()
+            with th.cuda.graph(graph, pool=self._cuda_graph_pool):
+                static_out = self.compute_params(static_inp)
+            self._cuda_graph_pool = graph.pool()
+            self._cuda_graphs[key] = (graph, static_inp, static_out)
+        graph, static_inp, static_out = self._cuda_graphs[key]
+        static_inp.copy_(feat_inp)
+        graph.replay()
+        return static_out
+
+    def _use_param_head_bufs(self) -> bool:
+        # While a CUDA graph is captured, the graph's own memory pool takes the role of the buffers
+        return not th.is_grad_enabled() and not self.config.use_compile \
+            and not (th.cuda.is_available() and th.cuda.is_current_stream_capturing())
+
+    def apply_param_head(self, head_name: str, x: th.Tensor) -> th.Tensor:
+        """
+            Applies the sum or dist param head to x.
+            If gradients are disabled, the output is written with addmm into a buffer that is reused by every call
+            with the same number of conditionals, instead of into a newly allocated tensor. The params that set_params
+            assigns to the layers then are views into this buffer, which the next call of set_params overwrites.
+
+        Args:
+            head_name: 'sum' or 'dist'
+            x: Output of the MLP of the head, of shape [num_conditionals, hidden_size]
+        """
+        head: nn.Linear = self.sum_param_head if head_name == 'sum' else self.dist_param_head
+        if not self._use_param_head_bufs() or x.dtype != head.weight.dtype:
+            # addmm with out= can't mix dtypes, which is the case under autocast
+            return head(x)
+        buf = self._param_head_bufs.get(head_name)
+        if buf is None or buf.shape != (x.shape[0], head.out_features) or buf.device != x.device \
+                or buf.dtype != x.dtype or buf.is_inference() != th.is_inference_mode_enabled():
+            buf = th.empty((x.shape[0], head.out_features), device=x.device, dtype=x.dtype)
+            self._param_head_bufs[head_name] = buf
+        return th.addmm(head.bias, x, head.weight.t(), out=buf)
 
     def clear_params(self):
+        self._last_condition = None
         for layer in self._inner_layers:
             if isinstance(layer, Sum):
                 weight_shape = (0, layer.in_features, layer.in_channels, layer.out_channels, layer.num_repetitions)
                 layer.weight_param = th.zeros(weight_shape)
+                layer._weights_need_norm = False
             else:
                 layer.num_conditionals = 0
 
         # Set normalized weights of the root sum layer
         weight_shape = (0, self.root.in_features, self.root.in_channels, self.root.out_channels, self.root.num_repetitions)
         self.root.weight_param = th.zeros(weight_shape)
+        self.root._weights_need_norm = False
 
-        # Sampling root weights need to have 5 dims as well
-        weight_shape = (0, 1, 1, 1, 1)
-        self._sampling_root.weight_param = th.zeros(weight_shape).to(self.device)
+        if self._sampling_root is not None:
+            # Sampling root weights need to have 5 dims as well
+            weight_shape = (0, 1, 1, 1, 1)
+            self._sampling_root.weight_param = th.zeros(weight_shape).to(self.device)
 
         # Set bounded weights of the Gaussian distributions in the leaves
         dist_param_shape = (0, self._leaf.base_leaf.in_features, self.config.I, self.config.R)
@@ -326,7 +536,8 @@ class CSPN(RatSpn):
         self._leaf.base_leaf.std_param = th.zeros(dist_param_shape)
 
     def save(self, *args, **kwargs):
-        save_model = CSPN(self.config)
+        # Scripted modules can't be pickled, so the saved model is never scripted. The state dict is the same.
+        save_model = CSPN(dataclasses.replace(self.config, use_jit=False))
         save_model.load_state_dict(self.state_dict())
         th.save(save_model, *args, **kwargs)
 
@@ -101,12 +101,32 @@ class RatNormal(Leaf):
             # stds = th.clamp(stds, self.min_log_sigma, self.max_log_sigma)
         return stds
 
+    def bounded_means_(self, means: th.Tensor):
+        """In-place version of bounded_means()."""
+        if self.min_mean is not None or self.max_mean is not None:
+            means.sigmoid_().mul_(self.max_mean - self.min_mean).add_(self.min_mean)
+        return means
+
+    def bounded_stds_(self, stds: th.Tensor):
+        """In-place version of bounded_stds()."""
+        if self._stds_in_lin_space:
+            if self._stds_sigmoid_bound:
+                stds.sigmoid_().mul_(self.max_sigma - self.min_sigma).add_(self.min_sigma)
+            else:
+                stds.copy_(F.softplus(stds)).add_(self.min_sigma)
+        else:
+            stds.copy_(F.softplus(stds)).add_(self.min_log_sigma)
+        return stds
+
     @property
     def means(self):
         if self._ratspn:
             return self.bounded_means()
         else:
-            assert ((self.min_mean <= self.mean_param) & (self.mean_param <= self.max_mean)).all()
+            if self.min_mean is not None:
+                assert (self.min_mean <= self.mean_param).all()
+            if self.max_mean is not None:
+                assert (self.mean_param <= self.max_mean).all()
             return self.mean_param
 
     @means.setter
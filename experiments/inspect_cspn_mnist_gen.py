@@ -137,12 +137,16 @@ if __name__ == "__main__":
         # sample = model.sample_index_style(condition=label, is_mpe=False)
         sample = model.sample_onehot_style(condition=label, is_mpe=False)
         sample.mean().backward()
-        print(f"dist std head weight grads max {model.dist_std_head.weight.grad.max()}")
-        print(f"dist std head bias grads max {model.dist_std_head.bias.grad.max()}")
+        print(f"dist param head weight grads max {model.dist_param_head.weight.grad.max()}")
+        print(f"dist param head bias grads max {model.dist_param_head.bias.grad.max()}")
+        head_weight_grads = model.sum_param_head.weight.grad
+        head_bias_grads = model.sum_param_head.bias.grad
         print(
-            f"sum param heads weight grads max {[lay.weight.grad.max() if lay.weight.grad is not None else 0 for lay in model.sum_param_heads]}")
+            f"sum param heads weight grads max "
+            f"{[g.max() for g in head_weight_grads.split(model._sum_split_sizes)] if head_weight_grads is not None else 0}")
         print(
-            f"sum param heads bias grads max {[lay.bias.grad.max() if lay.bias.grad is not None else 0 for lay in model.sum_param_heads]}")
+            f"sum param heads bias grads max "
+            f"{[g.max() for g in head_bias_grads.split(model._sum_split_sizes)] if head_bias_grads is not None else 0}")
         for lay in model.dist_layers:
             if isinstance(lay, nn.Linear):
                 print(f"Dist layer weight grads max {lay.weight.grad.max()}")
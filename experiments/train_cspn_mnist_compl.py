@@ -166,7 +166,8 @@ def evaluate_model(model: torch.nn.Module, device, loader, tag) -> float:
     """
     model.eval()
     loss_ce = 0
-    loss_nll = 0
+    # Accumulated in place on the device and read once after the loop
+    loss_nll = torch.zeros((), device=device)
     correct = 0
     criterion = nn.CrossEntropyLoss(reduction="sum")
     with torch.no_grad():
@@ -177,12 +178,12 @@ def evaluate_model(model: torch.nn.Module, device, loader, tag) -> float:
             data = data.reshape(data.shape[0], -1)
             output = model(data, cond)
             loss_ce += criterion(output, target).item()  # sum up batch loss
-            loss_nll += -output.sum()
+            loss_nll.sub_(output.sum())
             pred = output.argmax(dim=1)
             correct += (pred == target).sum().item()
 
     loss_ce /= len(loader.dataset)
-    loss_nll /= len(loader.dataset) + 28 ** 2
+    loss_nll = loss_nll.item() / (len(loader.dataset) + 28 ** 2)
     accuracy = 100.0 * correct / len(loader.dataset)
 
     print(
@@ -199,9 +200,10 @@ def plot_samples(x: torch.Tensor, path):
     Args:
         x (torch.Tensor): Batch of input images. Has to be shape: [N, C, H, W].
     """
-    # Normalize in valid range
-    for i in range(x.shape[0]):
-        x[i, :] = (x[i, :] - x[i, :].min()) / (x[i, :].max() - x[i, :].min())
+    # Normalize each image in valid range
+    x_min = x.amin(dim=(1, 2, 3), keepdim=True)
+    x_max = x.amax(dim=(1, 2, 3), keepdim=True)
+    x.sub_(x_min).div_((x_max - x_min).clamp_min_(1e-8))
 
     tensors = torchvision.utils.make_grid(x, nrow=10, padding=1).cpu()
     arr = tensors.permute(1, 2, 0).numpy()
@@ -1,7 +1,10 @@
+import io
 import os
 import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from inspect import signature
 
 import imageio
 import numpy as np
@@ -14,19 +17,25 @@ from torchvision import datasets, transforms
 import matplotlib.pyplot as plt
 
 from distributions import RatNormal
-from cspn import CSPN, CspnConfig
+from cspn import CSPN, CspnConfig, print_cspn_params
 
-from train_mnist import one_hot, count_params, ensure_dir, set_seed
+from train_mnist import one_hot, ensure_dir, set_seed
 
+# Writes the plots and checkpoints in the background, one at a time and in the order they were submitted
+write_executor = ThreadPoolExecutor(max_workers=1)
+# Futures of the writes that weren't checked yet. See wait_for_writes.
+pending_writes = []
 
-def print_cspn_params(cspn: CSPN):
-    print(f"Total params in CSPN: {count_params(cspn)}")
-    print(f"Params to extract features from the conditional: {count_params(cspn.feat_layers)}")
-    print(f"Params in MLP for the sum params, excluding the heads: {count_params(cspn.sum_layers)}")
-    print(f"Params in the heads of the sum param MLPs: {sum([count_params(head) for head in cspn.sum_param_heads])}")
-    print(f"Params in MLP for the dist params, excluding the heads: {count_params(cspn.dist_layers)}")
-    print(f"Params in the heads of the dist param MLPs: "
-          f"{count_params(cspn.dist_mean_head) + count_params(cspn.dist_std_head)}")
+
+def submit_write(fn, *args):
+    """Run fn(*args) in the background writer. Its errors are raised by wait_for_writes."""
+    pending_writes.append(write_executor.submit(fn, *args))
+
+
+def wait_for_writes():
+    """Wait for the submitted writes to finish. Raises the error of the first write that failed."""
+    while pending_writes:
+        pending_writes.pop(0).result()
 
 
 def time_delta(t_delta: float) -> str:
@@ -45,22 +54,28 @@ def time_delta(t_delta: float) -> str:
     return f"{hours} hours, {minutes} minutes, {seconds} seconds, {millisecs} milliseconds"
 
 
-def get_stl_loaders(dataset_dir, use_cuda, grayscale, device, batch_size):
+def get_stl_loaders(dataset_dir, use_cuda, grayscale, device, batch_size, num_workers=8):
     """
     Get the STL10 pytorch data loader.
 
     Args:
         use_cuda: Use cuda flag.
+        num_workers: Number of worker processes of each loader. They are kept alive across epochs.
 
     """
-    kwargs = {"num_workers": 8, "pin_memory": True} if use_cuda else {}
+    kwargs = {"num_workers": num_workers}
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
+    if use_cuda:
+        kwargs["pin_memory"] = True
 
     test_batch_size = batch_size
 
+    # The images stay uint8 in the loaders. See to_float_image.
     if grayscale:
-        transformer = transforms.Compose([transforms.ToTensor(), transforms.Grayscale()])
+        transformer = transforms.Compose([transforms.PILToTensor(), transforms.Grayscale()])
     else:
-        transformer = transforms.Compose([transforms.ToTensor()])
+        transformer = transforms.Compose([transforms.PILToTensor()])
     # Train data loader
     train_loader = torch.utils.data.DataLoader(
         datasets.STL10(dataset_dir, split='train+unlabeled', download=True, transform=transformer),
@@ -79,6 +94,14 @@ def get_stl_loaders(dataset_dir, use_cuda, grayscale, device, batch_size):
     return train_loader, test_loader
 
 
+def to_float_image(image: torch.Tensor, device) -> torch.Tensor:
+    """
+    Move a uint8 image batch of the STL10 loaders to the device and scale it to [0, 1], like ToTensor() does.
+    Converting after the copy keeps the worker processes and the host-to-device copy at a quarter of the bytes.
+    """
+    return image.to(device, non_blocking=True).float().div_(255)
+
+
 def evaluate_model(model, cut_fcn, insert_fcn, save_dir, device, loader, tag):
     """
     Description for method evaluate_model.
@@ -101,26 +124,35 @@ def evaluate_model(model, cut_fcn, insert_fcn, save_dir, device, loader, tag):
         model.eval()
         spn_per_channel = False
 
-    log_like = []
-    with torch.no_grad():
+    # The param MLPs of the models run under bfloat16 autocast if they were created with config.use_amp
+    with torch.inference_mode():
+        # Summed on the device, so that the loop doesn't synchronize with it at every batch
+        log_like = torch.zeros((), device=device)
+        num_lls = 0
         n = 50
         for image, _ in loader:
-            image = image.to(device)
+            image = to_float_image(image, device)
             _, cond = cut_fcn(image)
+            # One sample of shape [conditionals, features] per conditional. The CSPN evaluates it with the
+            # shape [1, conditionals, features, 1, 1].
             if not spn_per_channel:
-                sample = model.sample(condition=cond)
-                log_like.append(model(x=sample, condition=None).mean().tolist())
+                sample = model.sample(mode='index', condition=cond.flatten(start_dim=1)).sample.view(len(cond), -1)
+                log_like += model(x=sample[None, :, :, None, None], condition=None).mean()
+                num_lls += 1
             else:
-                sample = [model[ch].sample(condition=cond[:, [ch]]) for ch in range(len(model))]
-                log_like += [model[ch](x=sample[ch], condition=None).mean().tolist()
-                             for ch in range(len(model))]
+                sample = [model[ch].sample(mode='index', condition=cond[:, ch].flatten(start_dim=1)).sample
+                          for ch in range(len(model))]
+                sample = [ch_sample.view(len(cond), -1) for ch_sample in sample]
+                for ch in range(len(model)):
+                    log_like += model[ch](x=sample[ch][None, :, :, None, None], condition=None).mean()
+                num_lls += len(model)
                 sample = torch.cat(sample, dim=1)
 
             if n > 0:
                 insert_fcn(sample[:n], cond[:n])
                 plot_samples(cond[:n], save_dir)
                 n = 0
-    print("{} set: Average log-likelihood of samples: {:.4f}".format(tag, np.mean(log_like)))
+    print("{} set: Average log-likelihood of samples: {:.4f}".format(tag, log_like.item() / num_lls))
 
 
 def plot_samples(x: torch.Tensor, path):
@@ -131,15 +163,82 @@ def plot_samples(x: torch.Tensor, path):
         x (torch.Tensor): Batch of input images. Has to be shape: [N, C, H, W].
     """
     # Clip to valid range
-    x[x < 0.0] = 0.0
-    x[x > 1.0] = 1.0
-
-    tensors = torchvision.utils.make_grid(x, nrow=10, padding=1).cpu()
+    x.clamp_(0.0, 1.0)
+
+    tensors = torchvision.utils.make_grid(x, nrow=10, padding=1)
+    copied = None
+    if tensors.is_cuda:
+        # Copy to host memory asynchronously. The writer waits for the copy, the caller doesn't.
+        tensors = tensors.to('cpu', non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record()
+    submit_write(write_png, tensors, path, copied)
+
+
+def write_png(tensors: torch.Tensor, path, copied: torch.cuda.Event = None):
+    """Write an image grid of shape [C, H, W] to a file. Waits for the event first, if one is given."""
+    if copied is not None:
+        copied.synchronize()
     arr = tensors.permute(1, 2, 0).numpy()
     arr = skimage.img_as_ubyte(arr)
     imageio.imwrite(path, arr)
 
 
+def save_checkpoint(model: CSPN, optimizer: optim.Optimizer, epoch: int, path):
+    """
+    Save the state dicts of the model and its optimizer, together with the config to rebuild the model.
+    The checkpoint is serialized here, but written to the file in the background.
+    """
+    buf = io.BytesIO()
+    torch.save({'config': model.config, 'model': model.state_dict(), 'optim': optimizer.state_dict(),
+                'epoch': epoch}, buf)
+    submit_write(write_bytes_atomic, buf.getvalue(), path)
+
+
+def write_bytes_atomic(data: bytes, path):
+    """Write to a temporary file first, so that the file at path is never partially written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, device) -> CSPN:
+    """
+    Rebuild the model of a checkpoint written by save_checkpoint.
+    Checkpoints written before save_checkpoint existed hold the whole pickled model, which is returned as is.
+    """
+    # The config holds classes, which newer torch versions don't unpickle by default. Older ones don't know the flag.
+    kwargs = {'weights_only': False} if 'weights_only' in signature(torch.load).parameters else {}
+    checkpoint = torch.load(path, map_location=device, **kwargs)
+    if isinstance(checkpoint, CSPN):
+        return checkpoint
+    model = CSPN(checkpoint['config']).to(device)
+    model.load_state_dict(checkpoint['model'])
+    return model
+
+
+def adam_kwargs(use_cuda: bool) -> dict:
+    """
+    Keyword args of optim.Adam. They are only passed if they are set, as older torch versions don't have them.
+    The fused implementation, which updates all params in a single kernel launch, is used on CUDA if it is available.
+    """
+    kwargs = {}
+    if use_cuda and 'fused' in signature(optim.Adam).parameters:
+        kwargs['fused'] = True
+    return kwargs
+
+
+def train_step(model: CSPN, optimizer: optim.Optimizer, data: torch.Tensor, cond: torch.Tensor) -> torch.Tensor:
+    """Do one optimization step of the negative log-likelihood of the data given the conditionals."""
+    optimizer.zero_grad(set_to_none=True)
+    output: torch.Tensor = model(data, cond)
+    loss = -output.mean()
+    loss.backward()
+    optimizer.step()
+    return loss
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -148,6 +247,7 @@ if __name__ == "__main__":
     parser.add_argument('--seed', '-s', type=int, default=0)
     parser.add_argument('--epochs', '-ep', type=int, default=100)
     parser.add_argument('--batch_size', '-bs', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of data loader worker processes.')
     parser.add_argument('--results_dir', type=str, default='.',
                         help='The base directory where the directory containing the results will be saved to.')
     parser.add_argument('--dataset_dir', type=str, default='../data',
@@ -158,23 +258,24 @@ if __name__ == "__main__":
     parser.add_argument('--num_dist', '-I', type=int, default=5, help='Number of Gauss dists per pixel.')
     parser.add_argument('--num_sums', '-S', type=int, default=5, help='Number of sums per RV in each sum layer.')
     parser.add_argument('--dropout', type=float, default=0.0, help='Dropout to apply')
-    parser.add_argument('--nr_conv_layers', type=int, default=1,
-                        help='Number of conv layers to apply to conditional image.')
-    parser.add_argument('--nr_sum_param_layers', type=int, default=1,
-                        help='Number of fully connected hidden layers in the MLP that '
-                             'provides the weights for the sum nodes.')
-    parser.add_argument('--nr_dist_param_layers', type=int, default=1,
-                        help='Number of fully connected hidden layers in the MLP that '
-                             'provides the params for the dist nodes')
+    parser.add_argument('--feat_layers', type=int, nargs='+',
+                        help='List of sizes of the CSPN feature layers.')
+    parser.add_argument('--sum_param_layers', type=int, nargs='+',
+                        help='List of sizes of the CSPN sum param layers.')
+    parser.add_argument('--dist_param_layers', type=int, nargs='+',
+                        help='List of sizes of the CSPN dist param layers.')
     parser.add_argument('--verbose', '-V', action='store_true', help='Output more debugging information when running.')
     parser.add_argument('--inspect', action='store_true', help='Enter inspection mode')
     parser.add_argument('--one_spn_per_channel', action='store_true', help='Create one SPN for each color channel.')
     parser.add_argument('--grayscale', action='store_true', help='Convert images to grayscale')
-    parser.add_argument('--sumfirst', action='store_true', help='Make first layer after dists a sum layer.')
+    parser.add_argument('--amp', action='store_true', help='Train with bfloat16 mixed precision on CUDA.')
+    parser.add_argument('--compile', action='store_true', help='Compile the CSPN with torch.compile.')
     args = parser.parse_args()
 
     assert not args.one_spn_per_channel or not args.grayscale, \
         "--one_spn_per_channel and --grayscale can't be set together!"
+    assert not args.compile or hasattr(nn.Module, 'compile'), \
+        f"--compile needs nn.Module.compile(), which was added in torch 2.2, but torch is {torch.__version__}!"
     set_seed(args.seed)
 
     results_dir = os.path.join(args.results_dir, f"results_{args.exp_name}")
@@ -191,7 +292,10 @@ if __name__ == "__main__":
     else:
         device = torch.device("cuda:0")
         use_cuda = True
-        torch.cuda.benchmark = True
+        # The conditionals always have the same shape, so cuDNN can benchmark its conv algorithms once
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     batch_size = args.batch_size
 
@@ -206,17 +310,23 @@ if __name__ == "__main__":
         img_size = (3, 96, 96)  # 3 channels
         center_cutout = (3, 32, 32)
 
-    cutout_rows = [img_size[1] // 2 - center_cutout[1] // 2, img_size[1] // 2 + center_cutout[1] // 2]
-    cutout_cols = [img_size[2] // 2 - center_cutout[2] // 2, img_size[2] // 2 + center_cutout[2] // 2]
+    # First row and column of the center cutout
+    cutout_row = img_size[1] // 2 - center_cutout[1] // 2
+    cutout_col = img_size[2] // 2 - center_cutout[2] // 2
+
+    def center_patch(image: torch.Tensor) -> torch.Tensor:
+        """View of the center cutout of the images."""
+        return image.narrow(2, cutout_row, center_cutout[1]).narrow(3, cutout_col, center_cutout[2])
 
     def cut_out_center(image: torch.Tensor) -> (torch.Tensor, torch.Tensor):
-        data = image[:, :, cutout_rows[0]:cutout_rows[1], cutout_cols[0]:cutout_cols[1]].clone()
-        cond = image
-        cond[:, :, cutout_rows[0]:cutout_rows[1], cutout_cols[0]:cutout_cols[1]] = 0
-        return data, cond
+        # Only the center is copied. The image itself becomes the conditional, with the center zeroed in place.
+        patch = center_patch(image)
+        data = patch.clone()
+        patch.zero_()
+        return data, image
 
     def insert_center(sample: torch.Tensor, cond: torch.Tensor):
-        cond[:, :, cutout_rows[0]:cutout_rows[1], cutout_cols[0]:cutout_cols[1]] = sample.view(-1, *center_cutout)
+        center_patch(cond).copy_(sample.view(-1, *center_cutout))
 
     inspect = args.inspect
     if inspect:
@@ -244,10 +354,10 @@ if __name__ == "__main__":
         models = []
         model = None
         if isinstance(path, list):
-            models = [torch.load(p).cpu() for p in path]
+            models = [load_checkpoint(p, torch.device('cpu')) for p in path]
             spn_per_channel = True
         else:
-            model = torch.load(path, map_location=torch.device('cpu'))
+            model = load_checkpoint(path, torch.device('cpu'))
             spn_per_channel = False
 
         show_all = True
@@ -258,24 +368,30 @@ if __name__ == "__main__":
             batch_size = 256
 
         train_loader, test_loader = get_stl_loaders(args.dataset_dir, False, args.grayscale,
-                                                    batch_size=batch_size, device=device)
+                                                    batch_size=batch_size, device=device,
+                                                    num_workers=args.num_workers)
         for i, (image, _) in enumerate(train_loader):
+            image = to_float_image(image, 'cpu')
             data, cond = cut_out_center(image.clone())
             cond = cond.repeat(5, 1, 1, 1)
             data = data.repeat(5, 1, 1, 1)
             image = image.repeat(5, 1, 1, 1)
+            # The CSPN takes inputs of shape [batch, conditionals, features, 1, 1], with one sample per conditional
             if spn_per_channel:
-                data = data.flatten(start_dim=2)
-                data_ll = [models[ch](x=data[:, ch], condition=cond[:, [ch]]) for ch in range(len(models))]
-                data_ll = torch.cat(data_ll, dim=1).mean(dim=1)
-                sample = [models[ch].sample(condition=None) for ch in range(len(models))]
-                sample_ll = [models[ch](x=sample[ch], condition=None) for ch in range(len(models))]
-                sample_ll = torch.cat(sample_ll, dim=1).mean(dim=1)
+                data = data.reshape(1, len(data), img_size[0], -1, 1, 1)
+                data_ll = [models[ch](x=data[:, :, ch], condition=cond[:, ch].flatten(start_dim=1)).flatten()
+                           for ch in range(len(models))]
+                data_ll = torch.stack(data_ll, dim=1).mean(dim=1)
+                sample = [models[ch].sample(mode='index', condition=None).sample.view(len(cond), -1)
+                          for ch in range(len(models))]
+                sample_ll = [models[ch](x=sample[ch][None, :, :, None, None], condition=None).flatten()
+                             for ch in range(len(models))]
+                sample_ll = torch.stack(sample_ll, dim=1).mean(dim=1)
                 sample = torch.cat(sample, dim=1)
             else:
-                data_ll = model(x=data.flatten(start_dim=1), condition=cond).flatten()
-                sample = model.sample(condition=None)
-                sample_ll = model(x=sample, condition=None).flatten()
+                data_ll = model(x=data.reshape(1, len(data), -1, 1, 1), condition=cond.flatten(start_dim=1)).flatten()
+                sample = model.sample(mode='index', condition=None).sample.view(len(cond), -1)
+                sample_ll = model(x=sample[None, :, :, None, None], condition=None).flatten()
 
             sample = sample.view(-1, *center_cutout)
             sample[sample < 0.0] = 0.0
@@ -321,14 +437,16 @@ if __name__ == "__main__":
         exit()
 
     # Construct Cspn from config
-    train_loader, test_loader = get_stl_loaders(args.dataset_dir, use_cuda, args.grayscale, batch_size=batch_size, device=device)
+    train_loader, test_loader = get_stl_loaders(args.dataset_dir, use_cuda, args.grayscale, batch_size=batch_size,
+                                                device=device, num_workers=args.num_workers)
     config = CspnConfig()
+    # The CSPN only takes 1-dim conditionals, so the conditional images are flattened before they are passed to it.
     if args.one_spn_per_channel:
         config.F = int(np.prod(center_cutout[1:]))
-        config.F_cond = (1, *img_size[1:])
+        config.F_cond = (int(np.prod(img_size[1:])),)
     else:
         config.F = int(np.prod(center_cutout))
-        config.F_cond = img_size
+        config.F_cond = (int(np.prod(img_size)),)
     config.R = args.repetitions
     config.D = args.cspn_depth
     config.I = args.num_dist
@@ -337,14 +455,13 @@ if __name__ == "__main__":
     config.dropout = 0.0
     config.leaf_base_class = RatNormal
     config.leaf_base_kwargs = {'min_sigma': 0.1, 'max_sigma': 1.0, 'min_mean': None, 'max_mean': None}
-    config.first_layer_sum = args.sumfirst
 
-    config.nr_feat_layers = args.nr_conv_layers
-    config.conv_kernel_size = 3
-    config.conv_pooling_kernel_size = 3
-    config.conv_pooling_stride = 3
-    config.fc_sum_param_layers = args.nr_sum_param_layers
-    config.fc_dist_param_layers = args.nr_dist_param_layers
+    config.feat_layers = args.feat_layers
+    config.sum_param_layers = args.sum_param_layers
+    config.dist_param_layers = args.dist_param_layers
+    # The CSPN runs its MLPs under bfloat16 autocast, but keeps the SPN params and log-likelihoods in float32.
+    # bfloat16 has the exponent range of float32, so the loss doesn't need a GradScaler.
+    config.use_amp = args.amp
 
     print("Using device:", device)
     print("Config:", config)
@@ -354,7 +471,10 @@ if __name__ == "__main__":
     model = None
     if args.one_spn_per_channel:
         models = [CSPN(config).to(device).train() for _ in range(img_size[0])]
-        optimizers = [optim.Adam(models[ch].parameters()) for ch in range(img_size[0])]
+        if args.compile:
+            for ch_model in models:
+                ch_model.compile()
+        optimizers = [optim.Adam(models[ch].parameters(), **adam_kwargs(use_cuda)) for ch in range(img_size[0])]
         for ch in range(img_size[0]):
             print(models[ch])
             print_cspn_params(models[ch])
@@ -362,70 +482,82 @@ if __name__ == "__main__":
         model = CSPN(config)
         model = model.to(device)
         model.train()
+        if args.compile:
+            # Compiles the calls of the model in place, so sample() and save() are still available.
+            # The default mode is used, as CUDA graphs of reduce-overhead would overwrite the params that
+            # set_params stores in the layers.
+            model.compile()
         print(model)
         print_cspn_params(model)
-        optimizer = optim.Adam(model.parameters(), lr=1e-3)
+        optimizer = optim.Adam(model.parameters(), lr=1e-3, **adam_kwargs(use_cuda))
 
     sample_interval = 1 if args.verbose else 10  # number of epochs
+    n_batches = len(train_loader)
+    log_interval = 50  # number of batches between the verbose prints
     for epoch in range(args.epochs):
         t_start = time.time()
-        running_loss = []
+        # The losses are summed on the device, so that logging them doesn't synchronize with it at every batch
+        running_loss = torch.zeros((), device=device)
+        num_losses = 0
         running_ent = []
         cond = None
         for batch_index, (image, _) in enumerate(train_loader):
             # Send data to correct device
-            image = image.to(device)
+            image = to_float_image(image, device)
             data, cond = cut_out_center(image)
             # plt.imshow(data[0].permute(1, 2, 0))
             # plt.show()
 
             # Inference
+            # The CSPN takes inputs of shape [batch, conditionals, features, 1, 1], with one sample per conditional
             if args.one_spn_per_channel:
-                data = data.reshape(image.shape[0], img_size[0], -1)
+                data = data.reshape(1, image.shape[0], img_size[0], -1, 1, 1)
                 for ch in range(img_size[0]):
-                    optimizers[ch].zero_grad()
-                    output: torch.Tensor = models[ch](data[:, ch], cond[:, [ch]])
+                    optimizers[ch].zero_grad(set_to_none=True)
+                    output: torch.Tensor = models[ch](data[:, :, ch], cond[:, ch].flatten(start_dim=1))
                     loss = -output.mean()
                     loss.backward()
                     optimizers[ch].step()
-                    running_loss.append(loss.item())
+                    running_loss += loss.detach()
+                    num_losses += 1
             else:
                 # evaluate_model(model, cut_out_center, insert_center, "test.png", device, train_loader, "Train")
-                model.entropy_lb(cond)
-                optimizer.zero_grad()
-                data = data.reshape(image.shape[0], -1)
-                output: torch.Tensor = model(data, cond)
-                loss = -output.mean()
-                loss.backward()
-                optimizer.step()
-                running_loss.append(loss.item())
+                data = data.reshape(1, image.shape[0], -1, 1, 1)
+                loss = train_step(model, optimizer, data, cond.flatten(start_dim=1))
+                running_loss += loss.detach()
+                num_losses += 1
 
                 # with torch.no_grad():
                 #     ent = model.log_entropy(condition=None).mean()
                 #     running_ent.append(ent.item())
 
             # Log stuff
-            if args.verbose:
+            if args.verbose and batch_index % log_interval == log_interval - 1:
+                # Reading the loss waits for the queued batches, so the time taken afterwards includes them
+                avg_loss = running_loss.item() / num_losses
                 batch_delta = time_delta((time.time()-t_start)/(batch_index+1))
-                print(f"Epoch {epoch} ({100.0 * batch_index / len(train_loader):.1f}%) "
-                      f"Avg. loss: {np.mean(running_loss):.2f} - Batch {batch_index} - "
+                print(f"Epoch {epoch} ({100.0 * batch_index / n_batches:.1f}%) "
+                      f"Avg. loss: {avg_loss:.2f} - Batch {batch_index} - "
                       f"Avg. batch time {batch_delta}",
                       end="\r")
 
         t_delta = time_delta(time.time()-t_start)
-        print("Train Epoch: {} took {}".format(epoch, t_delta))
+        print("Train Epoch: {} took {} - Avg. loss: {:.2f}".format(epoch, t_delta, running_loss.item() / num_losses))
         if epoch % sample_interval == (sample_interval-1):
+            # Errors of the previous writes surface here instead of getting lost in the background
+            wait_for_writes()
             print("Saving and evaluating model ...")
             if args.one_spn_per_channel:
                 for ch in range(img_size[0]):
-                    torch.save(models[ch], os.path.join(model_dir, f"epoch-{epoch:03}-chan{ch}.pt"))
+                    save_checkpoint(models[ch], optimizers[ch], epoch,
+                                    os.path.join(model_dir, f"epoch-{epoch:03}-chan{ch}.pt"))
                 save_path = os.path.join(sample_dir, f"epoch-{epoch:03}.png")
                 evaluate_model(models, cut_out_center, insert_center, save_path, device, train_loader, "Train")
                 evaluate_model(models, cut_out_center, insert_center, save_path, device, test_loader, "Test")
             else:
-                torch.save(model, os.path.join(model_dir, f"epoch-{epoch:03}.pt"))
+                save_checkpoint(model, optimizer, epoch, os.path.join(model_dir, f"epoch-{epoch:03}.pt"))
                 save_path = os.path.join(sample_dir, f"epoch-{epoch:03}.png")
                 evaluate_model(model, cut_out_center, insert_center, save_path, device, train_loader, "Train")
                 evaluate_model(model, cut_out_center, insert_center, save_path, device, test_loader, "Test")
 
-
+    wait_for_writes()
@@ -70,6 +70,8 @@ class Sum(AbstractLayer):
         # Weights, such that each sumnode has its own weights. conditionals := w = 1 in the RatSpn case.
         ws = th.randn(1, self.in_features, self.in_channels, self.out_channels, self.num_repetitions)
         self.weight_param = nn.Parameter(ws)
+        # If True, weight_param holds unnormalized weights which are log-normalized when they are first accessed.
+        self._weights_need_norm = False
         self._bernoulli_dist = th.distributions.Bernoulli(probs=self.dropout)
 
         self.out_shape = f"(N, {self.in_features}, {self.out_channels}, {self.num_repetitions})"
@@ -100,14 +102,38 @@ class Sum(AbstractLayer):
         """Hack to obtain the current device, this layer lives on."""
         return self.weight_param.device
 
+    def __setstate__(self, state):
+        # Sum layers pickled before the deferred normalization always hold normalized weights
+        state.setdefault('_weights_need_norm', False)
+        super().__setstate__(state)
+
+    def set_unnormalized_weights(self, weights: th.Tensor):
+        """
+        Set weights that are not yet log-normalized over the in_channels dimension.
+        The log-normalization is deferred until the weights are accessed for the first time. This way, the weights
+        of layers that are never evaluated are never normalized.
+
+        Args:
+            weights: Unnormalized log weights of shape [w, d, ic, oc, r].
+        """
+        self.weight_param = weights
+        self._weights_need_norm = True
+
     @property
     def weights(self):
         # weights need to have shape [w, d, ic, oc, r]. In the RatSpn case, w is always 1
         if self.ratspn:
             return F.log_softmax(self.weight_param, dim=2)
         else:
-            assert th.allclose(self.weight_param.exp().sum(2), th.as_tensor(1.0))
-            return self.weight_param
+            weights = self.weight_param
+            if self._weights_need_norm:
+                weights = F.log_softmax(weights, dim=2)
+                # Weights normalized under no_grad are detached, so they are only cached if they need no gradients.
+                if th.is_grad_enabled() or not self.weight_param.requires_grad:
+                    self.weight_param = weights
+                    self._weights_need_norm = False
+            assert th.allclose(weights.exp().sum(2), th.as_tensor(1.0))
+            return weights
 
     def forward(self, x: th.Tensor, detach_params: bool = False):
         """
@@ -1,3 +1,4 @@
+import functools
 import logging
 from typing import Dict, Type, List, Union, Optional, Tuple, Callable
 import math
@@ -8,8 +9,6 @@ from dataclasses import dataclass
 from torch import nn
 from torch.nn import functional as F
 from torch import distributions as dist
-import scipy.optimize
-import matplotlib.pyplot as plt
 
 from base_distributions import Leaf
 from layers import CrossProduct, Sum
@@ -88,10 +87,20 @@ class RatSpnConfig:
             raise Exception(f"The tree depth D={self.D} must be <= {np.floor(np.log2(self.F))} (log2(in_features).")
 
     def __setattr__(self, key, value):
-        if hasattr(self, key):
+        if key in settable_config_attributes(type(self)):
             super().__setattr__(key, value)
         else:
-            raise AttributeError(f"RatSpnConfig object has no attribute {key}")
+            raise AttributeError(f"{type(self).__name__} object has no attribute {key}")
+
+
+@functools.lru_cache(maxsize=None)
+def settable_config_attributes(config_class: type) -> frozenset:
+    """
+    The attributes that can be set on a config object: Its dataclass fields and its properties, such as F.
+    Computed once per config class, so that setting an attribute is a set lookup instead of a hasattr() call.
+    """
+    properties = {name for name in dir(config_class) if isinstance(getattr(config_class, name), property)}
+    return frozenset(config_class.__dataclass_fields__) | properties
 
 
 class RatSpn(nn.Module):
@@ -175,7 +184,8 @@ class RatSpn(nn.Module):
         """
         assert x.size(-1) == 1 or x.size(-1) == self.config.R
         if x.size(-1) == 1:
-            x = x.repeat(*([1] * (x.dim()-1)), self.config.R)
+            # gather reads from the broadcast view, so x is never copied R times
+            x = x.expand(*x.shape[:-1], self.config.R)
         perm_indices = self.permutation.unsqueeze(-2).expand_as(x)
         x = th.gather(x, dim=-3, index=perm_indices)
         return x
@@ -192,7 +202,8 @@ class RatSpn(nn.Module):
         """
         assert x.size(-1) == 1 or x.size(-1) == self.config.R
         if x.size(-1) == 1:
-            x = x.repeat(*([1] * (x.dim()-1)), self.config.R)
+            # gather reads from the broadcast view, so x is never copied R times
+            x = x.expand(*x.shape[:-1], self.config.R)
         perm_indices = self.inv_permutation.unsqueeze(-2).expand_as(x)
         x = th.gather(x, dim=-3, index=perm_indices)
         return x
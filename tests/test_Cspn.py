@@ -0,0 +1,267 @@
+import unittest
+
+from typing import Dict, List
+
+import torch as th
+import torch.nn.functional as F
+from torch import nn, optim
+
+from cspn import CSPN, CspnConfig
+from distributions import RatNormal
+from layers import Sum
+
+
+def build_cspn(C: int = 1) -> CSPN:
+    config = CspnConfig()
+    config.F_cond = (10,)
+    config.C = C
+    config.F = 8
+    config.R = 3
+    config.D = 2
+    config.I = 3
+    config.S = 3
+    config.dropout = 0.0
+    config.feat_layers = [16]
+    config.sum_param_layers = [16]
+    config.dist_param_layers = [16]
+    config.cond_layers_inner_act = nn.LeakyReLU
+    config.leaf_base_class = RatNormal
+    config.tanh_squash = True
+    config.leaf_base_kwargs = {'min_sigma': 0.01, 'max_sigma': 1.0}
+    return CSPN(config)
+
+
+class CspnSetParamsTest(unittest.TestCase):
+    """Tests of the reuse of the params that set_params computed for the last conditional."""
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        self.model = build_cspn()
+        self.cond = th.randn(5, 10)
+        self.x = th.randn(2, 5, 8, 1, 1)
+
+        # Count how often the params are computed
+        self.num_computations = 0
+        compute_params = self.model.compute_params
+
+        def counting_compute_params(feat_inp):
+            self.num_computations += 1
+            return compute_params(feat_inp)
+        self.model.compute_params = counting_compute_params
+
+    def test_same_condition_reuses_params(self):
+        with th.no_grad():
+            self.model(self.x, self.cond)
+            means = self.model._leaf.base_leaf.mean_param
+            self.model(self.x, self.cond)
+        assert self.num_computations == 1
+        assert self.model._leaf.base_leaf.mean_param is means
+
+    def test_optimizer_step_invalidates_params(self):
+        optimizer = optim.Adam(self.model.parameters())
+        with th.no_grad():
+            self.model(self.x, self.cond)
+        loss = -self.model(self.x, th.randn(5, 10)).mean()
+        loss.backward()
+        optimizer.step()
+        with th.no_grad():
+            self.model(self.x, self.cond)
+        assert self.num_computations == 3
+
+    def test_inplace_condition_edit_invalidates_params(self):
+        with th.no_grad():
+            self.model(self.x, self.cond)
+            means = self.model._leaf.base_leaf.mean_param.clone()
+            self.cond.add_(1.0)
+            self.model(self.x, self.cond)
+        assert self.num_computations == 2
+        assert not th.equal(self.model._leaf.base_leaf.mean_param, means)
+
+    def test_grad_accumulation(self):
+        self.model(self.x, self.cond).mean().backward()
+        grads = [p.grad.clone() for p in self.model.parameters() if p.grad is not None]
+        self.model(self.x, self.cond).mean().backward()
+        assert self.num_computations == 2
+        accumulated = [p.grad for p in self.model.parameters() if p.grad is not None]
+        for grad, acc_grad in zip(grads, accumulated):
+            assert th.allclose(2 * grad, acc_grad)
+
+    def test_calls_with_grad_have_separate_graphs(self):
+        output = self.model(self.x, self.cond)
+        other_output = self.model(th.randn(2, 5, 8, 1, 1), self.cond)
+        output.mean().backward()
+        other_output.mean().backward()
+
+        samples = self.model.sample(mode='onehot', condition=self.cond, n=2).sample
+        output = self.model(self.x, self.cond)
+        samples.mean().backward()
+        output.mean().backward()
+
+    def test_switching_grad_mode_recomputes_params(self):
+        with th.no_grad():
+            self.model(self.x, self.cond)
+        output = self.model(self.x, self.cond)
+        assert output.requires_grad
+        with th.no_grad():
+            output = self.model(self.x, self.cond)
+        assert not output.requires_grad
+        assert self.num_computations == 3
+
+    def test_params_without_grad_are_overwritten_by_next_call(self):
+        with th.no_grad():
+            self.model.set_params(self.cond)
+            means = self.model._leaf.base_leaf.mean_param
+            means_copy = means.clone()
+            self.model.set_params(th.randn(5, 10))
+        # The params set without gradients are views into buffers that the next call reuses
+        assert not th.equal(means, means_copy)
+        assert th.equal(means, self.model._leaf.base_leaf.mean_param)
+
+    def test_casting_invalidates_params(self):
+        with th.no_grad():
+            self.model(self.x, self.cond)
+            # Casting replaces the params, so the params of the last conditional were computed with the old ones
+            self.model.double().float()
+            self.model(self.x, self.cond)
+        assert self.num_computations == 2
+
+
+class CspnGradTest(unittest.TestCase):
+    """Tests that gradients reach the params of the CSPN through all ways of evaluating it."""
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        self.model = build_cspn()
+        self.cond = th.randn(5, 10)
+
+    def grads_of(self, fn) -> List[th.Tensor]:
+        self.model.zero_grad(set_to_none=True)
+        th.manual_seed(1)
+        fn().backward()
+        return [p.grad for p in self.model.parameters() if p.requires_grad]
+
+    def normalize_sum_weights_eagerly(self):
+        for layer in [*self.model._inner_layers, self.model.root]:
+            if isinstance(layer, Sum):
+                layer.weight_param = F.log_softmax(layer.weight_param, dim=2)
+                layer._weights_need_norm = False
+
+    def assert_grads_match_eager_normalization(self, fn):
+        """
+        fn evaluates the CSPN for a conditional, or for the params that are already set if it is None.
+        Its gradients must be the same as with sum weights that are normalized right after set_params.
+        """
+        grads = self.grads_of(lambda: fn(self.cond))
+
+        def eager_fn():
+            self.model.set_params(self.cond)
+            self.normalize_sum_weights_eagerly()
+            return fn(None)
+        eager_grads = self.grads_of(eager_fn)
+
+        for grad, eager_grad in zip(grads, eager_grads):
+            assert grad is not None
+            assert th.allclose(grad, eager_grad)
+
+    def test_naive_entropy_grads(self):
+        # The samples are drawn without gradients, but the log-likelihoods of them need gradients
+        self.assert_grads_match_eager_normalization(
+            lambda cond: self.model.naive_entropy_approx(condition=cond, sample_size=10)
+        )
+
+    def test_naive_entropy_grads_of_samples_with_grad(self):
+        self.assert_grads_match_eager_normalization(
+            lambda cond: self.model.naive_entropy_approx(condition=cond, sample_size=10, sample_with_grad=True)
+        )
+
+    def test_recursive_entropy_grads(self):
+        self.assert_grads_match_eager_normalization(
+            lambda cond: self.model.recursive_entropy_approx(condition=cond)[0].mean()
+        )
+
+    def test_huber_entropy_lb_grads(self):
+        self.assert_grads_match_eager_normalization(
+            lambda cond: self.model.huber_entropy_lb(condition=cond, verbose=False)[0].mean()
+        )
+
+    def test_onehot_sample_grads(self):
+        self.assert_grads_match_eager_normalization(
+            lambda cond: self.model.sample(mode='onehot', condition=cond, n=3).sample.mean()
+        )
+
+
+
+class CspnUnfusedHeadsTest(unittest.TestCase):
+    """Tests of loading the state dicts of CSPNs with one head per Sum layer and separate dist mean and std heads."""
+
+    @staticmethod
+    def unfused_state_dict(model: CSPN) -> Dict[str, th.Tensor]:
+        state_dict = model.state_dict()
+        for param in ['weight', 'bias']:
+            sum_params = state_dict.pop(f"sum_param_head.{param}").split(model._sum_split_sizes)
+            for i, sum_param in enumerate(sum_params):
+                state_dict[f"sum_param_heads.{i}.{param}"] = sum_param
+            mean_param, std_param = state_dict.pop(f"dist_param_head.{param}").chunk(2)
+            state_dict[f"dist_mean_head.{param}"] = mean_param
+            state_dict[f"dist_std_head.{param}"] = std_param
+        return state_dict
+
+    def test_load_unfused_state_dict(self):
+        for C in [1, 3]:
+            with self.subTest(C=C):
+                th.manual_seed(0)
+                model = build_cspn(C=C)
+                cond = th.randn(5, 10)
+                x = th.randn(2, 5, 8, 1, 1)
+                state_dict = self.unfused_state_dict(model)
+
+                th.manual_seed(1)
+                loaded_model = build_cspn(C=C)
+                loaded_model.load_state_dict(state_dict)
+                with th.no_grad():
+                    assert th.equal(loaded_model(x, cond), model(x, cond))
+
+
+
+class CspnBoundedParamsTest(unittest.TestCase):
+    """Tests that the in-place bounding of the leaf params in set_params matches the out-of-place bounding."""
+
+    def test_bounded_means_inplace(self):
+        for kwargs in [{}, {'tanh_squash': True}, {'min_mean': -2.0, 'max_mean': 3.0}]:
+            with self.subTest(**kwargs):
+                leaf = RatNormal(in_features=8, out_channels=3, ratspn=False, num_repetitions=2, **kwargs)
+                means = th.randn(5, 8, 3, 2)
+                assert th.allclose(leaf.bounded_means_(means.clone()), leaf.bounded_means(means))
+
+    def test_bounded_stds_inplace(self):
+        for kwargs in [{}, {'stds_sigmoid_bound': False}, {'stds_in_lin_space': False}]:
+            with self.subTest(**kwargs):
+                leaf = RatNormal(in_features=8, out_channels=3, ratspn=False, num_repetitions=2,
+                                 min_sigma=0.01, max_sigma=2.0, **kwargs)
+                stds = th.randn(5, 8, 3, 2)
+                assert th.allclose(leaf.bounded_stds_(stds.clone()), leaf.bounded_stds(stds))
+
+
+
+class CspnSingleRootTest(unittest.TestCase):
+    """Tests of a CSPN with C == 1, which has no sampling root."""
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        self.model = build_cspn(C=1)
+        self.cond = th.randn(5, 10)
+
+    def test_sample_and_forward(self):
+        assert self.model._sampling_root is None
+        for mode in ['index', 'onehot']:
+            with self.subTest(mode=mode):
+                samples = self.model.sample(mode=mode, condition=self.cond, n=3).sample
+                assert samples.shape == (1, 3, 5, 8, 1)
+                x = samples.reshape(3, 5, 8, 1, 1)
+                log_probs = self.model(x, self.cond)
+                assert log_probs.shape[:2] == (3, 5)
+                assert th.isfinite(log_probs).all()
+
+
+if __name__ == '__main__':
+    unittest.main()